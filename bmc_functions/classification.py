@@ -4,21 +4,93 @@ Description: Functions designed to assist with the creation and evaluation of cl
 
 By Ben McCarty (bmccarty505@gmail.com)'''
 
+### ----- Importing Dependencies ----- ###
+
+from weakref import WeakKeyDictionary
+
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+import seaborn as sns
+
+from sklearn import metrics
+from sklearn.base import ClassifierMixin
+from sklearn.svm import SVC, NuSVC
+
+def _argmax_is_predict(model):
+    """True when model.predict is the argmax of predict_proba and model.score
+    is plain accuracy - not the case for Platt-scaled SVMs or for
+    Pipeline/GridSearchCV objects with their own scorers."""
+    return (type(model).score is ClassifierMixin.score
+            and not isinstance(model, (SVC, NuSVC)))
+
+def _predict(model, X):
+    """Returns predicted probabilities and classes for X, deriving the classes
+    from the probabilities when that matches model.predict."""
+    prob = model.predict_proba(X)
+
+    if _argmax_is_predict(model):
+        y_hat = model.classes_[prob.argmax(1)]
+    else:
+        y_hat = model.predict(X)
+
+    return prob, y_hat
+
+def _score(model, X, y, y_hat):
+    """Returns model.score(X, y), computed from y_hat when it is plain accuracy."""
+    if _argmax_is_predict(model):
+        return round(float((y_hat == np.asarray(y).ravel()).mean()), 2)
+
+    return round(float(model.score(X, y)), 2)
+
+## Cached predict_proba results, per fitted model
+_PROBA_CACHE_SIZE = 8
+_proba_cache = WeakKeyDictionary()
+
+def _predict_cached(model, X):
+    """Returns _predict(model, X), reusing the results of an earlier call with
+    the same fitted model and identical X contents (hashed in full, so any
+    in-place edit to X forces a new prediction)."""
+    if isinstance(X, (pd.DataFrame, pd.Series)):
+        key = hash(pd.util.hash_pandas_object(X, index=False).values.tobytes())
+    elif isinstance(X, np.ndarray):
+        key = hash(X.tobytes())
+    else:
+        return _predict(model, X)
+    key = (X.shape, key)
+
+    ## A refit model gets a new classes_ array, which invalidates its entries
+    cache = _proba_cache.setdefault(model, {})
+    entry = cache.get(key)
+
+    if entry is None or entry[0] is not model.classes_:
+        entry = (model.classes_,) + _predict(model, X)
+
+        cache.pop(key, None)
+        if len(cache) >= _PROBA_CACHE_SIZE:
+            cache.pop(next(iter(cache)))
+        cache[key] = entry
+
+    return entry[1], entry[2]
+
 ## Generating scores for later comparisons
 
 def model_scores(model, X_train, y_train, X_test, y_test):
+    """Returns train/test scores (model.score) and log losses for a fitted classifier.
 
-    y_hat_train = model.predict(X_train)
-    prob_train = model.predict_proba(X_train)
+    For plain classifiers whose score is accuracy, predictions and accuracy
+    are derived from predict_proba; otherwise model.predict/model.score are used.
+    """
 
-    y_hat_test = model.predict(X_test)
-    prob_test = model.predict_proba(X_test)
+    ## Single (cached) predict_proba pass per split; predictions are derived from it where possible
+    prob_train, y_hat_train = _predict_cached(model, X_train)
+    prob_test, y_hat_test = _predict_cached(model, X_test)
 
-    base_train_ll = metrics.log_loss(y_train, prob_train).round(2)
-    base_test_ll = metrics.log_loss(y_test, prob_test).round(2)
+    base_train_ll = round(metrics.log_loss(y_train, prob_train, labels=model.classes_), 2)
+    base_test_ll = round(metrics.log_loss(y_test, prob_test, labels=model.classes_), 2)
 
-    base_train_score = model.score(X_train, y_train).round(2)
-    base_test_score = model.score(X_test,y_test).round(2)
+    base_train_score = _score(model, X_train, y_train, y_hat_train)
+    base_test_score = _score(model, X_test, y_test, y_hat_test)
 
 
     return base_train_score, base_test_score, base_train_ll, base_test_ll
@@ -28,14 +100,34 @@ def plot_comparison_hist(data, feature, target = None, bins = 'auto', alt_name =
 
     feature_name = feature.replace("_", " ").replace("'", "").title()
     
-    if len(list(data[feature].unique())) > 10:
-        ax = sns.histplot(data=data, x= data[feature] \
-                           .value_counts(ascending=False),
-                          hue = target, bins=bins)
+    ax = plt.gca()
+    uniq = data[feature].unique()
+
+    ## Counts are pre-aggregated so matplotlib only has to draw the bars
+    if target == None:
+        counts = data[feature].value_counts().sort_index().to_frame()
+    else:
+        counts = pd.crosstab(data[feature], data[target])
+
+    if len(uniq) > 10 and pd.api.types.is_numeric_dtype(data[feature]):
+        ## Continuous feature: shared bin edges, one overlaid histogram per class
+        edges = np.histogram_bin_edges(data[feature].dropna(), bins = bins)
+        for col in counts.columns:
+            hist, _ = np.histogram(counts.index, bins = edges,
+                                   weights = counts[col])
+            ax.bar(edges[:-1], hist, width = np.diff(edges), align = 'edge',
+                   alpha = .5)
     else:
-        ax = sns.histplot(data=data, x= feature, hue = target, bins = bins)
+        ## Discrete or non-numeric feature: one offset bar per class at each category
+        width = .8 / counts.shape[1]
+        positions = np.arange(len(counts))
+        for i, col in enumerate(counts.columns):
+            ax.bar(positions + (i - (counts.shape[1] - 1) / 2) * width,
+                   counts[col], width)
+        ax.set_xticks(positions)
+        ax.set_xticklabels(counts.index)
     
-    if list((data[feature].unique())) == [0,1]:
+    if set(uniq.tolist()) == {0, 1}:
         plt.xticks([0, 1], ['No', 'Yes'])
 
     if alt_name == None:
@@ -58,13 +150,11 @@ def plot_comparison_count(data,feature, target = 'review_scores_rating',
     feature_name = feature.replace("_", " ").title()
     
     
-    if len(list(data[feature].unique())) > 10:
-        ax = sns.countplot(data=data, x= feature,
-                          hue = target)
-    else:
-        ax = sns.countplot(data=data, x= feature, hue = target)
+    ## Counts are pre-aggregated so matplotlib only has to draw the bars
+    counts = data.groupby([feature, target]).size().unstack(fill_value = 0)
+    ax = counts.plot.bar(ax = plt.gca(), rot = 0, stacked = False)
     
-    if list((data[feature].unique())) == [0,1]:
+    if counts.index.tolist() == [0,1]:
         plt.xticks([0, 1], ['No', 'Yes'])
 
     if print_target != None:
@@ -84,18 +174,19 @@ def plot_comparison_count(data,feature, target = 'review_scores_rating',
 
 ##
 def plot_depths(fitted_model, verbose = False):
-    depths = []
+    ## Collecting depths into an array so max and mean are single reductions
+    depths = np.fromiter((i.tree_.max_depth for i in fitted_model.estimators_),
+                         dtype = np.int32,
+                         count = len(fitted_model.estimators_))
+    mean_depth = depths.mean()
 
-    for i in fitted_model.estimators_:
-        depths.append(i.get_depth())
-
-    print(f'\nThe maximum depth is: {np.max(depths)}\n')
+    print(f'\nThe maximum depth is: {depths.max()}\n')
 
     ax = sns.histplot(depths)
 
     ax.set(title = 'Tree Depths Used in RandomForestClassifier',
            xlabel = 'Depths', ylabel = 'Number of Trees')
-    ax.axvline(np.mean(depths), label = f'Mean: {np.mean(depths):.0f}',
+    ax.axvline(mean_depth, label = f'Mean: {mean_depth:.0f}',
                color='k')
 
     plt.legend(loc=0);
@@ -125,29 +216,22 @@ def plot_importances(model, X_train_df, count = 10, return_importances = False,
     
     importances = importances.sort_values(ascending = False)
 
-    top_imp = list(importances.sort_values(ascending = False).index[:count])
-   
-    for i in range(len(top_imp)):
-    
-        if top_imp[i] == 'minimum_nights_avg_ntm':
-            top_imp[i] = 'minimum_avg_nights.'
-        if top_imp[i] == 'maximum_nights_avg_ntm':
-            top_imp[i] = 'maximum_avg_nights.'
-        if top_imp[i] == 'host_listings_count':
-            top_imp[i] = 'number_of_host_regional_listings'
-        if top_imp[i] == 'host_total_listings_count':
-            top_imp[i] = 'number_of_host_overall_listings'
-        if top_imp[i] == 'num_bathrooms':
-            top_imp[i] = 'number_of_bathrooms'
-        if top_imp[i] == 'host_is_superhost':
-            top_imp[i] = 'is_superhost'
-        
-            
-        top_imp[i] = top_imp[i].replace("_", " ").title()
+    top_imp = importances.head(count)
+
+    ## Friendlier display names for specific features
+    renames = {'minimum_nights_avg_ntm': 'minimum_avg_nights.',
+               'maximum_nights_avg_ntm': 'maximum_avg_nights.',
+               'host_listings_count': 'number_of_host_regional_listings',
+               'host_total_listings_count': 'number_of_host_overall_listings',
+               'num_bathrooms': 'number_of_bathrooms',
+               'host_is_superhost': 'is_superhost'}
 
-    ax = importances[:count].plot(kind= 'barh')
+    top_labels = [renames.get(col, col).replace("_", " ").title()
+                  for col in top_imp.index]
+
+    ax = top_imp.plot(kind= 'barh')
     ax.set(title=f'Top {count} Strongest Predictors', xlabel='Strength',
-                yticklabels=top_imp)
+                yticklabels=top_labels)
     
     if save_fig == True:
         plt.savefig(f'{model_name}_feat_imp.png')
@@ -170,7 +254,8 @@ def evaluate_classification(model,X_train, y_train, X_test, y_test, metric,
         y_train (Dataframe): y-train data
         X_test (Dataframe): X-test data
         y_test (Dataframe): y-test data
-        metric (string): Text string to specify preferred performance metric
+        metric (string): Label for the model's score (model.score - accuracy for plain
+            classifiers, the configured scorer for GridSearchCV/Pipeline)
         verbose (bool, optional): 0, 1, 2. Defaults to True.
         labels (string, optional): Classes for predictions. Defaults to None.
         cmap (str, optional): Color pallette for confusion matrix. Defaults to 'Blues'.
@@ -180,18 +265,20 @@ def evaluate_classification(model,X_train, y_train, X_test, y_test, metric,
     Returns:
         [type]: [description]
     """                    
-    
-    from sklearn import metrics
-    import matplotlib.pyplot as plt
 
     print('\n|' + '----'*8 + ' Classification Metrics ' + '---'*11 + '--|\n')
     
+    ## Single (cached) predict_proba pass per split; reused for scores, log loss, and reports
+    ## (predictions come from model.predict when its argmax shortcut would differ)
+    prob_train, y_hat_train = _predict_cached(model, X_train)
+    prob_test, y_hat_test = _predict_cached(model, X_test)
+
     ### --- Scores --- ###
 
-    train_score = model.score(X_train, y_train).round(2)
+    train_score = _score(model, X_train, y_train, y_hat_train)
     print(f'Training {metric} score: {train_score}')
 
-    test_score = model.score(X_test,y_test).round(2)
+    test_score = _score(model, X_test, y_test, y_hat_test)
     print(f'Testing {metric} score: {test_score}')
 
     difference = train_score - test_score
@@ -206,19 +293,16 @@ def evaluate_classification(model,X_train, y_train, X_test, y_test, metric,
 
     ### --- Log Loss --- ###
 
-    y_hat_train = model.predict(X_train)
-    prob_train = model.predict_proba(X_train)
-
-    y_hat_test = model.predict(X_test)
-    prob_test = model.predict_proba(X_test)
+    train_ll = metrics.log_loss(y_train, prob_train, labels=model.classes_)
+    test_ll = metrics.log_loss(y_test, prob_test, labels=model.classes_)
 
-    print(f"\n\nTraining data Log Loss: {metrics.log_loss(y_train, prob_train):.2f}")
-    print(f"Testing data log loss: {metrics.log_loss(y_test, prob_test):.2f}\n")
+    print(f"\n\nTraining data Log Loss: {train_ll:.2f}")
+    print(f"Testing data log loss: {test_ll:.2f}\n")
 
     if verbose == 2:
-        if metrics.log_loss(y_test, prob_test) >= .66:
+        if test_ll >= .66:
             print('\tThe log loss for the testing data is high, indicating a poorly-performing model.')
-        elif metrics.log_loss(y_test, prob_test) <= .33:
+        elif test_ll <= .33:
             print('\tThe log loss for the testing data is low, indicating a well-performing model.')
         else:
             print('\tThe log loss for the testing data is moderate, indicating a weakly-performing model.')
@@ -229,30 +313,31 @@ def evaluate_classification(model,X_train, y_train, X_test, y_test, metric,
     print(metrics.classification_report(y_test, y_hat_test,
                                     target_names=labels))
 
-    fig, ax = plt.subplots(ncols=2, figsize = figsize)
-    metrics.plot_confusion_matrix(model, X_test,y_test,cmap=cmap,
-                            normalize=normalize, display_labels=labels,
-                            ax=ax[0])
-
-    curve = metrics.plot_roc_curve(model, X_test,y_test,ax=ax[1])
-    curve.ax_.grid()
-    curve.ax_.plot([0,1],[0,1], ls=':')
-    plt.tight_layout()
-    plt.show()
-
     print('\n|' + '----'*7 + ' Classification Report - Training Data ' + '---'*8 + '|\n')
     print(metrics.classification_report(y_train, y_hat_train,
                                 target_names=labels))
 
-    fig, ax = plt.subplots(ncols=2, figsize = figsize)
-    metrics.plot_confusion_matrix(model, X_train,y_train,cmap=cmap,
-                            normalize=normalize, display_labels=labels,
-                            ax=ax[0])
+    ## One figure for both splits: testing on the top row, training below
+    fig, axes = plt.subplots(nrows=2, ncols=2,
+                             figsize = (figsize[0], figsize[1]*2))
+
+    for row, (split, y_true, y_hat, prob) in enumerate(
+            [('Testing', y_test, y_hat_test, prob_test),
+             ('Training', y_train, y_hat_train, prob_train)]):
+
+        metrics.ConfusionMatrixDisplay.from_predictions(y_true, y_hat,
+                                cmap=cmap, normalize=normalize,
+                                display_labels=labels, ax=axes[row, 0])
+        axes[row, 0].set_title(f'{split} Data')
+
+        curve = metrics.RocCurveDisplay.from_predictions(y_true, prob[:, 1],
+                                pos_label=model.classes_[1],
+                                name=type(model).__name__, ax=axes[row, 1])
+        curve.ax_.grid()
+        curve.ax_.plot([0,1],[0,1], ls=':')
+        curve.ax_.set_title(f'{split} Data')
 
-    curve = metrics.plot_roc_curve(model, X_train,y_train,ax=ax[1])
-    curve.ax_.grid()
-    curve.ax_.plot([0,1],[0,1], ls=':')
-    plt.tight_layout()
+    fig.tight_layout()
     plt.show()
 
     return None
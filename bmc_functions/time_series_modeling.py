@@ -12,6 +12,8 @@ import pandas as pd
 
 import statsmodels.tsa.api as tsa
 
+from joblib import Parallel, delayed
+
 import pmdarima as pmd
 from pmdarima.arima import ndiffs
 from pmdarima.arima import nsdiffs
@@ -105,23 +107,36 @@ def plot_acf_pacf(data, lags=52, suptitle=None, figsize = (10,5)):
 ### --------------- Modeling --------------- ###
 
 # Creating train/test split for time series modeling
-def ts_split(dataframe, threshold=.85, show_vis=False, figsize=(10,5)):
+def ts_split(dataframe, threshold=.85, show_vis=False, figsize=(10,5), build_vis=True):
     """Creates train/test split for time series modeling.
 
     Args:
         timeseries_df (DataFrame): DataFrame or Series to be modeled
         threshold (float): Threshold (as decimal percent) for splitting data. Defaults to .85.
         show_vis (boolean): Whether to show a visualization of the split data. Detaults to False.
+        build_vis (boolean): Whether to build the split visualization at all. Defaults to True.
 
     Returns:
-        train, test: Initial DataFrame/Series split into sub-Series for modeling
+        train, test, fig: Initial DataFrame/Series split into sub-Series for modeling,
+                          split visualization (None if build_vis is False)
     """
 
     # split_dict = {}
 
     tts_cutoff = round(dataframe.shape[0]*threshold)
-    train = dataframe.iloc[:tts_cutoff]
-    test = dataframe.iloc[tts_cutoff:]
+
+    ## Slicing the underlying array skips the .iloc indexer for Series
+    if isinstance(dataframe, pd.Series):
+        vals, idx = dataframe.values, dataframe.index
+        train = pd.Series(vals[:tts_cutoff], index=idx[:tts_cutoff], name=dataframe.name)
+        test = pd.Series(vals[tts_cutoff:], index=idx[tts_cutoff:], name=dataframe.name)
+    else:
+        train = dataframe.iloc[:tts_cutoff]
+        test = dataframe.iloc[tts_cutoff:]
+
+    ## Skipping figure construction entirely when it isn't needed
+    if not build_vis:
+        return train, test, None
 
     fig,ax=plt.subplots(figsize = figsize)
 
@@ -140,24 +155,31 @@ def ts_split(dataframe, threshold=.85, show_vis=False, figsize=(10,5)):
     return train, test, fig
 
 ## Display model results
-def model_performance(ts_model):
+def model_performance(ts_model, show_vis = False):
     """Displays a fitted model's summary and plot diagnostics.
 
     Args:
         ts_model (model): fitted model for evaluation
+        show_vis (boolean, optional): Whether to keep the diagnostics figure open for display. Defaults to False.
     """    
     perf = {}
 
     perf['summary'] = ts_model.summary()
 
-    perf['diagnostics'] = ts_model.plot_diagnostics(figsize = (12, 6))
+    fig = ts_model.plot_diagnostics(figsize = (12, 6))
+    if show_vis:
+        fig.tight_layout()
+    else:
+        plt.close(fig)
+
+    perf['diagnostics'] = fig
 
     return perf
 
 ## Generate best model parameters via auto_arima
 def auto_arima_model(timeseries_dataset, m = 12, start_p=0,max_p=5,
                         start_q=0,max_q=5,start_P=0,
-                        start_Q=0, max_P=5, max_Q = 5):
+                        start_Q=0, max_P=5, max_Q = 5, maxiter = 50):
     
     """Fits an auto_arima model to a given timeseries dataset.
 
@@ -172,6 +194,7 @@ def auto_arima_model(timeseries_dataset, m = 12, start_p=0,max_p=5,
         start_Q (int, optional): Starting value for "Q". Defaults to 0.
         max_P (int, optional): Max value for "P". Defaults to 3.
         max_Q (int, optional): Max value for "Q". Defaults to 3.
+        maxiter (int, optional): Max optimizer iterations per candidate fit. Defaults to 50 (pmdarima's default).
 
     Returns:
         auto_arima_model: Fitted auto_arima model for use in SARIMAX modeling.
@@ -186,7 +209,9 @@ def auto_arima_model(timeseries_dataset, m = 12, start_p=0,max_p=5,
                                 start_q = start_q, max_q = max_q,
                                 start_P = start_P, max_P = max_P,
                                 start_Q = start_Q, max_Q = max_Q,
-                                d = n_d, D = n_D, error_action="ignore")
+                                d = n_d, D = n_D, error_action="ignore",
+                                stepwise = True, maxiter = maxiter,
+                                with_intercept = 'auto', n_jobs = 1)
 
     return auto_arima_model
 
@@ -230,26 +255,40 @@ def create_best_model(timeseries_dataset,m=12,start_p=0,max_p=5,
     return auto_model_best, best_model
 
 ## Using get_forecast to generate forecasted data
-def forecast_and_ci(model, test_data):
+def forecast_and_ci(model, test_data, with_ci=True):
     """Generate forecast for a given model
 
     Args:
         model: fitted SARIMAX model
         test_data (Series): Test data
+        with_ci (boolean, optional): Whether to include confidence intervals. Defaults to True.
     """    
     forecast = model.get_forecast(steps=len(test_data))
-    forecast_df = forecast.conf_int()
-    forecast_df.columns = ['Lower CI','Upper CI']
-    forecast_df['Forecast'] = forecast.predicted_mean
+
+    ## Point forecast only - the forecast variance is already computed by get_forecast;
+    ## this only skips building the interval bounds and summary frame
+    if not with_ci:
+        return forecast.predicted_mean.to_frame('Forecast')
+
+    ## summary_frame builds the mean and confidence intervals together
+    forecast_df = forecast.summary_frame()[['mean_ci_lower','mean_ci_upper','mean']]
+    forecast_df = forecast_df.rename(columns={'mean_ci_lower': 'Lower CI',
+                                              'mean_ci_upper': 'Upper CI',
+                                              'mean': 'Forecast'})
+    forecast_df.columns.name = None
 
     return forecast_df
 
 ## Plotting training, testing datasets
-def plot_forecast_ttf(train, test, forecast_df, figsize = (10,5), show_vis = False):
+def plot_forecast_ttf(train, test, forecast_df, figsize = (10,5), show_vis = False, build_vis = True):
     
     # train = split_dict.get('train')
     # test = split_dict.get('test')
 
+    ## Skipping figure construction entirely when it isn't needed
+    if not build_vis:
+        return {'figure': None}
+
     last_n_lags=len(train)
     
     fig,ax=plt.subplots(figsize = figsize)
@@ -275,8 +314,12 @@ def plot_forecast_ttf(train, test, forecast_df, figsize = (10,5), show_vis = Fal
     return ttf_dict
 
 ## Plotting training, testing datasets
-def plot_forecast_final(zipcode_val, forecast_full, figsize=(10,5), show_vis = False):
+def plot_forecast_final(zipcode_val, forecast_full, figsize=(10,5), show_vis = False, build_vis = True):
     ## Plotting original data and forecasted results
+
+    ## Skipping figure construction entirely when it isn't needed
+    if not build_vis:
+        return {'figure': None}
     
     fig,ax=plt.subplots(figsize=figsize)
 
@@ -303,16 +346,20 @@ def plot_forecast_final(zipcode_val, forecast_full, figsize=(10,5), show_vis = F
 
 ### --------------- Workflow --------------- ###
 
-def ts_modeling_workflow(dataframe, zipcode, threshold = .85, m= 12,figsize = (10,5), show_vis = False):
+def ts_modeling_workflow(dataframe, zipcode, threshold = .85, m= 12,figsize = (10,5), show_vis = False, build_vis = True):
     """Functionalizes total time series modeling workflow 
     starting with time series dataset through final forecasted data and ROI.
 
+    The final forecast extends the training model to the full series without
+    refitting, so it uses parameters estimated on the training portion only.
+
     Args:
         dataframe (DataFrame): Original dataframe from which to select series
         zipcode (string): Series name to model and forecast.
         threshold (float, optional): Threshold to determine train/test split. Defaults to .85.
         m (int, optional): The number of periods in each season (for seasonal differencing). Defaults to 12.
         n_yrs_past (int, optional): Number of past years for visualizations. Defaults to 5.
+        build_vis (boolean, optional): Whether to build the split/forecast figures. Defaults to True.
     """
 
     tsa_results = {}
@@ -320,33 +367,36 @@ def ts_modeling_workflow(dataframe, zipcode, threshold = .85, m= 12,figsize = (1
     forecast_vis = {}
 
     ## Select values for the selected zipcode
-    zipcode_val = dataframe[zipcode].copy()
+    zipcode_val = dataframe[zipcode]
 
     ## Split dataset
 
-    train, test, split_fig = ts_split(zipcode_val, threshold, show_vis = show_vis, figsize=figsize)
+    train, test, split_fig = ts_split(zipcode_val, threshold, show_vis = show_vis, figsize=figsize,
+                                      build_vis = build_vis)
 
     forecast_vis['split'] = split_fig
 
     ## Generating auto_arima model and SARIMAX model
     ## (based on best parameters from auto_arima model)
-    auto_model_train, best_model_train = create_best_model(timeseries_dataset = train, m=m)
+    _, best_model_train = create_best_model(timeseries_dataset = train, m=m)
     
     ## Saving training model results
-    metrics['train'] = model_performance(best_model_train)
-
-    ## Generating dataframe to store forecast results
-    forecast_train = forecast_and_ci(best_model_train, test)
-
-    ## Plotting forecast results against train/test split
-    forecast_vis['train'] = plot_forecast_ttf(train, test, forecast_df = forecast_train, figsize=figsize)
+    metrics['train'] = model_performance(best_model_train, show_vis = show_vis)
+
+    ## Generating validation forecast and plotting it against train/test split
+    ## (the validation forecast is only used for this plot)
+    if build_vis:
+        forecast_train = forecast_and_ci(best_model_train, test)
+        forecast_vis['train'] = plot_forecast_ttf(train, test, forecast_df = forecast_train,
+                                                  figsize=figsize, show_vis = show_vis)
+    else:
+        forecast_vis['train'] = {'figure': None}
 
-    ## Fitting best model using whole dataset
-    best_model_full = tsa.SARIMAX(zipcode_val,order=auto_model_train.order,
-                            seasonal_order = auto_model_train.seasonal_order,
-                            enforce_invertibility=False).fit()
+    ## Extending best model to the whole dataset
+    ## (re-runs the filter with the trained parameters instead of refitting)
+    best_model_full = best_model_train.append(test, refit=False)
 
-    metrics['full'] = model_performance(best_model_full)
+    metrics['full'] = model_performance(best_model_full, show_vis = show_vis)
 
     ## Using get_forecast to generate forecasted data
     best_forecast = forecast_and_ci(best_model_full, test)
@@ -354,23 +404,58 @@ def ts_modeling_workflow(dataframe, zipcode, threshold = .85, m= 12,figsize = (1
     tsa_results['forecasted_prices'] = best_forecast
 
     ## Plotting original data and forecast results
-    forecast_vis['full'] = plot_forecast_final(zipcode_val, tsa_results['forecasted_prices'], figsize=figsize)
+    forecast_vis['full'] = plot_forecast_final(zipcode_val, tsa_results['forecasted_prices'], figsize=figsize,
+                                               show_vis = show_vis, build_vis = build_vis)
     
     ## Calculating investment cost and ROI across dataframe
-    investment_cost = tsa_results['forecasted_prices'].iloc[0,2]
-    tsa_results['roi'] = (tsa_results['forecasted_prices'] - investment_cost)/investment_cost*100
+    ## (full ROI DF is kept to pull ROI based on smallest len(test) for all zips)
+    forecast_full = tsa_results['forecasted_prices']
+    investment_cost = forecast_full.iloc[0,2]
+    tsa_results['roi'] = (forecast_full - investment_cost)/investment_cost*100
+
+    ## Pulling ROI for final forecasted date
+    tsa_results['roi_final'] = tsa_results['roi'].iloc[-1].rename(str(zipcode_val.name))
     
     tsa_results['num_yrs_forecast'] = len(test)
     tsa_results['model_metrics'] = metrics
     tsa_results['model_visuals'] = forecast_vis
-
-    ## May be unused - need full ROI DF to pull ROI based on smallest len(test) for all zips
-    # ## Pulling ROI for final forecasted date
-    # roi_final = roi_df.iloc[-1]
-    # roi_final.name = zipcode_val.name.astype('str')
     
     return tsa_results
 
+def _batch_workflow(zipcode_df, zipcode, **kwargs):
+    """Runs ts_modeling_workflow inside a worker, closing any figures it built
+    so they don't pile up in reused worker processes."""
+    results = ts_modeling_workflow(zipcode_df, zipcode, **kwargs)
+
+    vis = results['model_visuals']
+    for fig in [vis['split'], vis['train']['figure'], vis['full']['figure']]:
+        if fig is not None:
+            plt.close(fig)
+
+    return results
+
+def make_dicts(dataframe, zipcodes, threshold = .85, m = 12, figsize = (10,5), build_vis = False, n_jobs = -1):
+    """Runs the time series modeling workflow for several zipcodes in parallel.
+
+    Args:
+        dataframe (DataFrame): Original dataframe from which to select series
+        zipcodes (list): Series names to model and forecast.
+        threshold (float, optional): Threshold to determine train/test split. Defaults to .85.
+        m (int, optional): The number of periods in each season (for seasonal differencing). Defaults to 12.
+        build_vis (boolean, optional): Whether to build the split/forecast figures. Defaults to False.
+        n_jobs (int, optional): Number of worker processes. Defaults to -1 (all cores).
+
+    Returns:
+        dict: ts_modeling_workflow results keyed by zipcode.
+    """
+
+    ## Each task only receives its own zipcode's column
+    results = Parallel(n_jobs=n_jobs, backend='loky')(
+        delayed(_batch_workflow)(dataframe[[zipcode]], zipcode, threshold = threshold,
+                                 m = m, figsize = figsize, build_vis = build_vis)
+        for zipcode in zipcodes)
+
+    return dict(zip(zipcodes, results))
 
 ## Deprecated due to updates in workflow function
 # def make_dict(dataframe, zipcode, threshold, m=12, show_vis = True, figsize=(12,4)):